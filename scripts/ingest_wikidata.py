@@ -1,16 +1,25 @@
+import functools
 import os
+import re
 import time
 import requests
-from datetime import datetime
+import requests_cache
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
+from urllib3.util import Retry
 from sqlalchemy import (
     Column,
     Integer,
     String,
     Float,
     ForeignKey,
+    bindparam,
     create_engine,
+    event,
+    func,
+    select,
 )
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker
+from sqlalchemy.orm import declarative_base, relationship
 
 
 # =========================
@@ -20,6 +29,14 @@ from sqlalchemy.orm import declarative_base, relationship, sessionmaker
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATABASE_URL = f"sqlite:///{os.path.join(BASE_DIR, 'helianthus.db')}"
 WIKIDATA_ENDPOINT = "https://query.wikidata.org/sparql"
+WIKIDATA_HEADERS = {
+    "Accept": "application/sparql-results+json",
+    "Accept-Encoding": "gzip",
+    "User-Agent": "HelianthusIngest/1.0"
+}
+WIKIDATA_CACHE_PATH = os.path.join(BASE_DIR, "wikidata_cache.sqlite")
+WIKIDATA_CACHE_EXPIRE = 24 * 60 * 60  # seconds
+WIKIDATA_ATTEMPTS = 5
 
 Base = declarative_base()
 
@@ -59,7 +76,8 @@ class Painting(Base):
     year = Column(Integer)
 
     artist_id = Column(Integer, ForeignKey("artists.id"), nullable=False)
-    location_id = Column(Integer, ForeignKey("locations.id"))
+    # SQLite does not index foreign keys on its own
+    location_id = Column(Integer, ForeignKey("locations.id"), index=True)
 
     artist = relationship("Artist", back_populates="paintings")
     location = relationship("Location", back_populates="paintings")
@@ -69,39 +87,145 @@ class Painting(Base):
 # Helpers
 # =========================
 
+_NUMBER = r"-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?"
+_COORDS_RE = re.compile(rf"Point\(({_NUMBER}) ({_NUMBER})\)")
+
+
 def qid_from_uri(uri: str) -> str:
-    return uri.rsplit("/", 1)[-1]
+    return uri.rpartition("/")[2]
+
+
+def year_from_date(date_val: str):
+    # xsd:dateTime such as "1889-01-01T00:00:00Z", "-" prefixed for BCE
+    sign = -1 if date_val.startswith("-") else 1
+    year_str = date_val.lstrip("-").partition("-")[0]
+
+    if not year_str.isdigit():
+        return None
+
+    return sign * int(year_str)
 
 
-def ensure_session():
+def ensure_engine():
     engine = create_engine(
         DATABASE_URL,
         connect_args={"check_same_thread": False}
     )
+
+    if engine.dialect.name == "sqlite":
+        @event.listens_for(engine, "connect")
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            # WAL + NORMAL: no fsync per commit, database stays consistent
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.execute("PRAGMA temp_store=MEMORY")
+            cursor.execute("PRAGMA cache_size=-64000")  # ~64 MB
+            cursor.close()
+
     Base.metadata.create_all(engine)
-    Session = sessionmaker(bind=engine)
-    return Session()
 
+    # create_all skips indexes on tables that already exist, so indexes
+    # added to the models later would never reach an existing database
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+    return engine
+
+
+def update_by_id(conn, model, rows):
+    """Executemany UPDATE keyed on id; NULL values keep what is stored."""
+    if not rows:
+        return
+
+    table = model.__table__
+    columns = [name for name in rows[0] if name != "id"]
+
+    stmt = table.update().where(table.c.id == bindparam("b_id")).values({
+        name: func.coalesce(bindparam(f"b_{name}"), table.c[name])
+        for name in columns
+    })
+    conn.execute(stmt, [
+        {f"b_{name}": value for name, value in row.items()}
+        for row in rows
+    ])
+
+
+@functools.lru_cache(maxsize=None)
+def get_http_session():
+    """Shared Wikidata session, created on first use rather than at import."""
+    # Re-runs for the same artist are served from the on-disk cache
+    session = requests_cache.CachedSession(
+        WIKIDATA_CACHE_PATH,
+        backend="sqlite",
+        expire_after=WIKIDATA_CACHE_EXPIRE,
+        allowable_codes=(200,),
+        allowable_methods=("GET", "POST"),
+    )
+    # Keep-alive pool so repeated queries reuse the TLS connection; transient
+    # failures back off exponentially with jitter and honour Retry-After
+    session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=16,
+            max_retries=Retry(
+                total=WIKIDATA_ATTEMPTS - 1,  # retries after the first attempt
+                backoff_factor=1.5,
+                backoff_jitter=1.0,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=["GET", "POST"],
+                respect_retry_after_header=True,
+            ),
+        ),
+    )
+    return session
+
+
+def body_read_failed(exc) -> bool:
+    """True if the response headers arrived but reading the body failed."""
+    if isinstance(exc, requests.exceptions.ChunkedEncodingError):
+        return True
+    return bool(exc.args) and isinstance(exc.args[0], ReadTimeoutError)
 
-def wikidata_query(query: str, timeout=30):
-    headers = {
-        "Accept": "application/sparql-results+json",
-        "User-Agent": "HelianthusIngest/1.0"
-    }
 
-    for attempt in range(3):
+def wikidata_query(query: str, timeout=30, refresh=False):
+    """Return the result bindings of a SPARQL query.
+
+    refresh skips the on-disk cache and overwrites the cached response.
+    """
+    # The adapter's Retry covers connecting and the response headers only;
+    # a timeout or dropped connection while reading the body lands here
+    session = get_http_session()
+
+    for attempt in range(WIKIDATA_ATTEMPTS):
+        if attempt:
+            time.sleep(2 ** (attempt - 1))  # back off before each retry only
+
         try:
-            r = requests.get(
+            # POST avoids URL length limits on long queries
+            r = session.post(
                 WIKIDATA_ENDPOINT,
-                params={"query": query},
-                headers=headers,
-                timeout=timeout
+                data={"query": query},
+                headers=WIKIDATA_HEADERS,
+                timeout=timeout,
+                force_refresh=refresh
             )
             r.raise_for_status()
-            return r.json()
-        except requests.exceptions.ReadTimeout:
-            print(f"Timeout attempt {attempt+1}, retrying...")
-            time.sleep(3)
+            return r.json().get("results", {}).get("bindings", [])
+        except requests.exceptions.JSONDecodeError:
+            # The cache stores any 200 before it is parsed; evict a cut-off
+            # body (e.g. a server-side query timeout) so the retry refetches
+            session.cache.delete(requests=[r.request])
+            print(f"Invalid JSON on attempt {attempt+1}")
+        except (
+            requests.exceptions.ChunkedEncodingError,
+            requests.exceptions.ConnectionError,
+        ) as exc:
+            if not body_read_failed(exc):
+                raise
+            print(f"Body read failed on attempt {attempt+1}")
 
     raise Exception("Wikidata query failed after retries")
 
@@ -110,7 +234,7 @@ def wikidata_query(query: str, timeout=30):
 # Artist Metadata
 # =========================
 
-def fetch_artist_label(artist_qid: str) -> str:
+def fetch_artist_label(artist_qid: str, refresh=False) -> str:
     query = f"""
     SELECT ?artistLabel WHERE {{
       wd:{artist_qid} rdfs:label ?artistLabel.
@@ -118,8 +242,7 @@ def fetch_artist_label(artist_qid: str) -> str:
     }}
     """
 
-    data = wikidata_query(query)
-    bindings = data.get("results", {}).get("bindings", [])
+    bindings = wikidata_query(query, refresh=refresh)
 
     if not bindings:
         return None
@@ -128,42 +251,74 @@ def fetch_artist_label(artist_qid: str) -> str:
 
 
 # =========================
-# Phase 1 – Paintings
+# Paintings & Locations
 # =========================
 
-def ingest_paintings(session, artist_qid: str, limit: int):
-    print("Phase 1: Ingesting paintings...")
+def ingest_paintings(conn, artist_qid: str, limit: int, refresh=False):
+    print("Ingesting paintings and locations...")
 
     sparql = f"""
-    SELECT ?painting ?paintingLabel ?date WHERE {{
-      ?painting wdt:P31 wd:Q3305213.
-      ?painting wdt:P170 wd:{artist_qid}.
+    SELECT ?painting ?paintingLabel ?date ?location ?locationLabel ?coords WHERE {{
+      # LIMIT applies to paintings; dates and locations fan out below
+      {{
+        SELECT DISTINCT ?painting WHERE {{
+          ?painting wdt:P31 wd:Q3305213;
+                    wdt:P170 wd:{artist_qid}.
+          wd:{artist_qid} wdt:P106 wd:Q1028181.
+        }}
+        LIMIT {limit}
+      }}
       OPTIONAL {{ ?painting wdt:P571 ?date. }}
-      SERVICE wikibase:label {{ bd:serviceParam wikibase:language "en". }}
+      OPTIONAL {{
+        ?painting rdfs:label ?paintingLabel.
+        FILTER (lang(?paintingLabel) = "en")
+      }}
+      OPTIONAL {{
+        ?painting wdt:P276|wdt:P195 ?location.
+        OPTIONAL {{ ?location wdt:P625 ?coords. }}
+        OPTIONAL {{
+          ?location rdfs:label ?locationLabel.
+          FILTER (lang(?locationLabel) = "en")
+        }}
+      }}
     }}
-    LIMIT {limit}
     """
 
-    data = wikidata_query(sparql, timeout=60)
-    bindings = data.get("results", {}).get("bindings", [])
+    bindings = wikidata_query(sparql, timeout=60, refresh=refresh)
+
+    # The occupation pattern above doubles as painter validation
+    if not bindings:
+        raise ValueError(
+            f"No paintings found for {artist_qid} (not a painter on Wikidata?)"
+        )
 
     # --- Artist ---
-    artist = session.query(Artist).filter_by(
-        wikidata_id=artist_qid
-    ).first()
+    artist_id = conn.execute(
+        select(Artist.id).where(Artist.wikidata_id == artist_qid)
+    ).scalar()
 
-    if not artist:
-        artist_name = fetch_artist_label(artist_qid)
+    if artist_id is None:
+        artist_name = fetch_artist_label(artist_qid, refresh=refresh)
 
-        artist = Artist(
-            wikidata_id=artist_qid,
-            name=artist_name
+        result = conn.execute(
+            Artist.__table__.insert().values(
+                wikidata_id=artist_qid,
+                name=artist_name
+            )
         )
+        artist_id = result.inserted_primary_key[0]
 
-        session.add(artist)
-        session.flush()
+    # Known QIDs -> primary keys, so only new rows go through INSERT
+    painting_id_by_qid = dict(
+        conn.execute(select(Painting.wikidata_id, Painting.id)).all()
+    )
+    location_id_by_qid = dict(
+        conn.execute(select(Location.wikidata_id, Location.id)).all()
+    )
 
-    inserted = 0
+    painting_rows = {}
+    location_rows = {}
+    painting_locations = {}
 
     # --- Paintings ---
     for row in bindings:
@@ -176,104 +331,108 @@ def ingest_paintings(session, artist_qid: str, limit: int):
 
         p_qid = qid_from_uri(p_uri)
 
-        year = None
-        if date_val:
-            try:
-                year = datetime.fromisoformat(
-                    date_val.replace("Z", "")
-                ).year
-            except Exception:
-                pass
-
-        painting = session.query(Painting).filter_by(
-            wikidata_id=p_qid
-        ).first()
-
-        if not painting:
-            painting = Painting(
-                wikidata_id=p_qid,
-                title=p_label,
-                year=year,
-                artist=artist
-            )
-            session.add(painting)
-            inserted += 1
-        else:
-            painting.title = p_label or painting.title
-            painting.year = year or painting.year
-
-    session.commit()
-    print(f"Inserted {inserted} paintings.")
+        year = year_from_date(date_val) if date_val else None
 
-# =========================
-# Phase 2 – Locations
-# =========================
+        # Rows repeat per date and location; merge them per painting
+        painting = painting_rows.setdefault(p_qid, {
+            "wikidata_id": p_qid,
+            "title": None,
+            "year": None,
+            "artist_id": artist_id,
+            "location_id": None,
+        })
+        painting["title"] = p_label or painting["title"]
+        painting["year"] = year or painting["year"]
 
-def enrich_locations(session):
-    print("Phase 2: Enriching locations...")
+        # --- Location ---
+        loc_uri = row.get("location", {}).get("value")
+        loc_label = row.get("locationLabel", {}).get("value")
+        coords_val = row.get("coords", {}).get("value")
 
-    paintings = session.query(Painting).filter(
-        Painting.location_id == None
-    ).all()
+        if not loc_uri or p_qid in painting_locations:
+            continue
 
-    for painting in paintings:
-        query = f"""
-        SELECT ?location ?locationLabel ?coords WHERE {{
-          wd:{painting.wikidata_id} wdt:P276|wdt:P195 ?location.
-          OPTIONAL {{ ?location wdt:P625 ?coords. }}
-          SERVICE wikibase:label {{ bd:serviceParam wikibase:language "en". }}
-        }}
-        """
+        loc_qid = qid_from_uri(loc_uri)
 
-        data = wikidata_query(query)
-        bindings = data.get("results", {}).get("bindings", [])
+        latitude = None
+        longitude = None
 
-        if not bindings:
+        # WKT literal: "Point(<longitude> <latitude>)"
+        m = _COORDS_RE.match(coords_val) if coords_val else None
+        if m:
+            longitude, latitude = float(m[1]), float(m[2])
+
+        location_rows[loc_qid] = {
+            "wikidata_id": loc_qid,
+            "name": loc_label,
+            "latitude": latitude,
+            "longitude": longitude,
+        }
+        painting_locations[p_qid] = loc_qid
+
+    # --- Locations ---
+    new_locations = []
+    location_updates = []
+
+    for loc_qid, row in location_rows.items():
+        if loc_qid not in location_id_by_qid:
+            new_locations.append(row)
             continue
 
-        row = bindings[0]
+        location_updates.append({
+            "id": location_id_by_qid[loc_qid],
+            "name": row["name"],
+            "latitude": row["latitude"],
+            "longitude": row["longitude"],
+        })
+
+    if new_locations:
+        conn.execute(Location.__table__.insert(), new_locations)
+        location_id_by_qid = dict(
+            conn.execute(select(Location.wikidata_id, Location.id)).all()
+        )
 
-        loc_uri = row.get("location", {}).get("value")
-        loc_label = row.get("locationLabel", {}).get("value")
-        coords_val = row.get("coords", {}).get("value")
+    update_by_id(conn, Location, location_updates)
 
-        if not loc_uri:
+    for p_qid, loc_qid in painting_locations.items():
+        painting_rows[p_qid]["location_id"] = location_id_by_qid[loc_qid]
+
+    # --- Paintings ---
+    new_paintings = []
+    painting_updates = []
+
+    for p_qid, row in painting_rows.items():
+        if p_qid not in painting_id_by_qid:
+            new_paintings.append(row)
             continue
 
-        loc_qid = qid_from_uri(loc_uri)
+        painting_updates.append({
+            "id": painting_id_by_qid[p_qid],
+            "title": row["title"],
+            "year": row["year"],
+            "location_id": row["location_id"],
+        })
 
-        latitude = None
-        longitude = None
+    if new_paintings:
+        conn.execute(Painting.__table__.insert(), new_paintings)
 
-        if coords_val:
-            try:
-                coords_str = coords_val.replace("Point(", "").replace(")", "")
-                lon_str, lat_str = coords_str.split()
-                longitude = float(lon_str)
-                latitude = float(lat_str)
-            except Exception:
-                pass
-
-        location = session.query(Location).filter_by(
-            wikidata_id=loc_qid
-        ).first()
-
-        if not location:
-            location = Location(
-                wikidata_id=loc_qid,
-                name=loc_label,
-                latitude=latitude,
-                longitude=longitude
-            )
-            session.add(location)
-            session.flush()
+    update_by_id(conn, Painting, painting_updates)
+
+    print(
+        f"Inserted {len(new_paintings)} paintings, "
+        f"{len(new_locations)} locations."
+    )
 
-        painting.location = location
-        session.commit()
 
-        time.sleep(0.2)  # be nice to Wikidata
+def run_ingest(artist_qid: str, limit: int = 200, refresh: bool = False):
+    engine = ensure_engine()
 
-    print("Location enrichment complete.")
+    try:
+        # One transaction for the whole run: a single commit at the end
+        with engine.begin() as conn:
+            ingest_paintings(conn, artist_qid, limit, refresh=refresh)
+    finally:
+        engine.dispose()
 
 
 # =========================
@@ -286,12 +445,14 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--artist", required=True)
     parser.add_argument("--limit", type=int, default=200)
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="ignore cached Wikidata responses and fetch them again"
+    )
 
     args = parser.parse_args()
 
-    session = ensure_session()
-
-    ingest_paintings(session, args.artist, args.limit)
-    enrich_locations(session)
+    run_ingest(args.artist, args.limit, refresh=args.refresh)
 
     print("Done.")
\ No newline at end of file